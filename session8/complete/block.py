@@ -21,6 +21,8 @@ TWO_WEEKS = 60 * 60 * 24 * 14
 class Block:
     command = b"block"
     define_network = True
+    # payload and checksum of the last envelope this block was sent in
+    envelope_cache = None
 
     def __init__(
         self, version, prev_block, merkle_root, timestamp, bits, nonce, tx_hashes=None
@@ -1,15 +1,21 @@
+import os
+import selectors
 import socket
+import struct
+import threading
 import time
 
+from functools import lru_cache
 from io import BytesIO
-from random import randint
+from operator import lt
 from unittest import TestCase
 
 from block import Block
 from helper import (
-    hash256,
+    bits_to_target,
     decode_base58,
     encode_varint,
+    hash256,
     int_to_little_endian,
     little_endian_to_int,
     read_varint,
@@ -31,55 +37,141 @@ PORT = {
     "testnet": 18333,
     "signet": 38333,
 }
+# IPv4 addresses are sent as IPv4-mapped IPv6 addresses
+IPV4_PREFIX = b"\x00" * 10 + b"\xff\xff"
+# magic, command padded with b"\x00" to 12 bytes, payload length and checksum
+ENVELOPE_HEADER = struct.Struct("<4s12sI4s")
+# fixed-size fields of a version message, from version through nonce
+VERSION_FIELDS = struct.Struct("<IQQQ16sHQ16sH8s")
+# latest block and relay flag at the end of a version message
+VERSION_TRAILER = struct.Struct("<I?")
+# a header in a headers message: version, previous block, merkle root,
+# timestamp, bits and nonce, followed by a tx count which has to be 0
+HEADER_RECORD = struct.Struct("<I32s32sI4s4sB")
+# data type and identifier of a getdata entry
+INVENTORY_ITEM = struct.Struct("<I32s")
+# most systems refuse a sendmsg with more buffers than this
+IOV_MAX = 1024
+# initial size of the buffer SimpleNode receives into
+RECV_BUFFER_SIZE = 2 * 1024 * 1024
+# largest payload a peer is allowed to send, same as Bitcoin Core
+MAX_PAYLOAD_LENGTH = 4 * 1000 * 1000
+
+
+# verack and other empty messages all share this checksum
+EMPTY_CHECKSUM = hash256(b"")[:4]
+
+
+def _checksum(payload):
+    """Returns the 4-byte envelope checksum of the payload"""
+    if not payload:
+        return EMPTY_CHECKSUM
+    return hash256(payload)[:4]
 
 
 class NetworkEnvelope:
-    def __init__(self, command, payload, network="mainnet"):
+    def __init__(
+        self,
+        command,
+        payload,
+        network="mainnet",
+        checksum=None,
+        magic=None,
+    ):
         self.command = command
         self.payload = payload
-        self.magic = MAGIC[network]
+        # callers that already know the magic can skip the lookup
+        if magic is None:
+            self.magic = MAGIC[network]
+        else:
+            self.magic = magic
+        # first four bytes of the hash256 of the payload, computed lazily
+        self.checksum = checksum
 
     def __repr__(self):
-        return '{self.command.decode("ascii")}: {self.payload.hex()}'
+        # only show the start of the payload, blocks can be megabytes
+        result = f'{self.command.decode("ascii")}({len(self.payload)}B): '
+        result += self.payload[:32].hex()
+        if len(self.payload) > 32:
+            result += "..."
+        return result
 
     @classmethod
-    def parse(cls, s, network="mainnet"):
+    def parse(cls, s, network="mainnet", verify_checksum=True):
         """Takes a stream and creates a NetworkEnvelope"""
-        # check the network magic
-        magic = s.read(4)
-        if magic == b"":
+        return cls.parse_with_magic(s, MAGIC[network], verify_checksum)
+
+    @classmethod
+    def parse_with_magic(cls, s, magic, verify_checksum=True):
+        """Takes a stream and the network magic bytes and creates a
+        NetworkEnvelope"""
+        command, payload_length, checksum = cls.parse_header(cls._read_header(s), magic)
+        # payload is of length payload_length
+        payload = s.read(payload_length)
+        # a short read can never match, so don't bother hashing it
+        if len(payload) != payload_length:
+            raise RuntimeError("payload is truncated")
+        return cls.from_payload(
+            command, payload, checksum, magic, verify_checksum=verify_checksum
+        )
+
+    @staticmethod
+    def _read_header(s):
+        """Reads the 24 byte header from a stream"""
+        header = s.read(24)
+        if len(header) != 24:
             raise RuntimeError("Connection reset!")
-        if magic != MAGIC[network]:
-            raise RuntimeError(
-                f"magic is not right {magic.hex()} vs {MAGIC[network].hex()}"
-            )
+        return header
+
+    @staticmethod
+    def parse_header(header, magic):
+        """Takes the 24 byte header as bytes or a memoryview and the network
+        magic and returns the command, payload length and checksum"""
+        # unpack all four fields in one go
+        got_magic, command, payload_length, checksum = ENVELOPE_HEADER.unpack(header)
+        # check the network magic
+        if got_magic != magic:
+            raise RuntimeError(f"magic is not right {got_magic.hex()} vs {magic.hex()}")
+        # refuse to read absurdly large payloads from a peer
+        if payload_length > MAX_PAYLOAD_LENGTH:
+            raise RuntimeError(f"payload is too long {payload_length}")
         # command 12 bytes, strip the trailing 0's using .strip(b'\x00')
-        command = s.read(12).strip(b"\x00")
-        # payload length 4 bytes, little endian
-        payload_length = little_endian_to_int(s.read(4))
+        return command.strip(b"\x00"), payload_length, checksum
+
+    @classmethod
+    def from_payload(cls, command, payload, checksum, magic, verify_checksum=True):
+        """Verifies the payload, which may be a memoryview, against the
+        checksum and creates a NetworkEnvelope. Skipping verification saves
+        hashing the payload when the peer is trusted"""
+        if verify_checksum:
+            # verify checksum
+            calculated_checksum = _checksum(payload)
+            if calculated_checksum != checksum:
+                raise RuntimeError("checksum does not match")
+        else:
+            # an unverified checksum mustn't be reused when serializing
+            checksum = None
+        # copy the payload out in case it is a view into a reused buffer
+        return cls(command, bytes(payload), checksum=checksum, magic=magic)
+
+    def serialize_header(self):
+        """Returns the 24 byte header that goes in front of the payload"""
         # checksum 4 bytes, first four of hash256 of payload
-        checksum = s.read(4)
-        # payload is of length payload_length
-        payload = s.read(payload_length)
-        # verify checksum
-        calculated_checksum = hash256(payload)[:4]
-        if calculated_checksum != checksum:
-            raise RuntimeError("checksum does not match")
-        return cls(command, payload, network=network)
+        if self.checksum is None:
+            self.checksum = _checksum(self.payload)
+        # network magic, command padded to 12 bytes, payload length 4 bytes
+        # little endian and the checksum
+        return ENVELOPE_HEADER.pack(
+            self.magic,
+            self.command,
+            len(self.payload),
+            self.checksum,
+        )
 
     def serialize(self):
         """Returns the byte serialization of the entire network message"""
-        # add the network magic using self.magic
-        result = self.magic
-        # command 12 bytes, fill leftover with b'\x00' * (12 - len(self.command))
-        result += self.command + b"\x00" * (12 - len(self.command))
-        # payload length 4 bytes, little endian
-        result += int_to_little_endian(len(self.payload), 4)
-        # checksum 4 bytes, first four of hash256 of payload
-        result += hash256(self.payload)[:4]
-        # payload
-        result += self.payload
-        return result
+        # header then payload
+        return self.serialize_header() + self.payload
 
     def stream(self):
         """Returns a stream for parsing the payload"""
@@ -101,6 +193,22 @@ class NetworkEnvelopeTest(TestCase):
         self.assertEqual(envelope.command, b"version")
         self.assertEqual(envelope.payload, msg[24:])
 
+    def test_parse_with_magic(self):
+        msg = bytes.fromhex("0b11090776657261636b000000000000000000005df6e0e2")
+        envelope = NetworkEnvelope.parse_with_magic(BytesIO(msg), MAGIC["testnet"])
+        self.assertEqual(envelope.command, b"verack")
+        self.assertEqual(envelope.serialize(), msg)
+        with self.assertRaises(RuntimeError):
+            NetworkEnvelope.parse_with_magic(BytesIO(msg), MAGIC["mainnet"])
+
+    def test_verify_checksum(self):
+        msg = bytes.fromhex("f9beb4d976657261636b0000000000000000000000000000")
+        with self.assertRaises(RuntimeError):
+            NetworkEnvelope.parse(BytesIO(msg))
+        envelope = NetworkEnvelope.parse(BytesIO(msg), verify_checksum=False)
+        self.assertEqual(envelope.command, b"verack")
+        self.assertEqual(envelope.serialize()[20:24].hex(), "5df6e0e2")
+
     def test_serialize(self):
         msg = bytes.fromhex("f9beb4d976657261636b000000000000000000005df6e0e2")
         stream = BytesIO(msg)
@@ -113,6 +221,16 @@ class NetworkEnvelopeTest(TestCase):
         envelope = NetworkEnvelope.parse(stream)
         self.assertEqual(envelope.serialize(), msg)
 
+    def test_checksum(self):
+        self.assertEqual(_checksum(b"").hex(), "5df6e0e2")
+        self.assertEqual(_checksum(b"\x00" * 8), hash256(b"\x00" * 8)[:4])
+
+    def test_repr(self):
+        envelope = NetworkEnvelope(b"ping", bytes.fromhex("0102030405060708"))
+        self.assertEqual(repr(envelope), "ping(8B): 0102030405060708")
+        envelope = NetworkEnvelope(b"tx", b"\xff" * 100)
+        self.assertEqual(repr(envelope), "tx(100B): " + "ff" * 32 + "...")
+
 
 class VersionMessage:
     command = b"version"
@@ -147,7 +265,8 @@ class VersionMessage:
         self.sender_ip = sender_ip
         self.sender_port = sender_port
         if nonce is None:
-            self.nonce = int_to_little_endian(randint(0, 2**64), 8)
+            # 8 random bytes straight from the OS
+            self.nonce = os.urandom(8)
         else:
             self.nonce = nonce
         self.user_agent = user_agent
@@ -156,37 +275,30 @@ class VersionMessage:
 
     def serialize(self):
         """Serialize this message to send over the network"""
-        # version is 4 bytes little endian
-        result = int_to_little_endian(self.version, 4)
-        # services is 8 bytes little endian
-        result += int_to_little_endian(self.services, 8)
-        # timestamp is 8 bytes little endian
-        result += int_to_little_endian(self.timestamp, 8)
-        # receiver services is 8 bytes little endian
-        result += int_to_little_endian(self.receiver_services, 8)
-        # IPV4 is 10 00 bytes and 2 ff bytes then receiver ip
-        result += b"\x00" * 10 + b"\xff\xff" + self.receiver_ip
-        # receiver port is 2 bytes, little endian
-        result += int_to_little_endian(self.receiver_port, 2)
-        # sender services is 8 bytes little endian
-        result += int_to_little_endian(self.sender_services, 8)
-        # IPV4 is 10 00 bytes and 2 ff bytes then sender ip
-        result += b"\x00" * 10 + b"\xff\xff" + self.sender_ip
-        # sender port is 2 bytes, little endian
-        result += int_to_little_endian(self.sender_port, 2)
-        # nonce
-        result += self.nonce
+        # version (4), services, timestamp, receiver services (8 each),
+        # receiver ip, receiver port (2), sender services (8), sender ip,
+        # sender port (2) and nonce (8), integers are little endian
+        # IPV4 is 10 00 bytes and 2 ff bytes then the ip
+        result = bytearray(
+            VERSION_FIELDS.pack(
+                self.version,
+                self.services,
+                self.timestamp,
+                self.receiver_services,
+                IPV4_PREFIX + self.receiver_ip,
+                self.receiver_port,
+                self.sender_services,
+                IPV4_PREFIX + self.sender_ip,
+                self.sender_port,
+                self.nonce,
+            )
+        )
         # useragent is a variable string, so varint first
         result += encode_varint(len(self.user_agent))
         result += self.user_agent
-        # latest block is 4 bytes little endian
-        result += int_to_little_endian(self.latest_block, 4)
-        # relay is 00 if false, 01 if true
-        if self.relay:
-            result += b"\x01"
-        else:
-            result += b"\x00"
-        return result
+        # latest block is 4 bytes little endian, relay is 01 if true else 00
+        result += VERSION_TRAILER.pack(self.latest_block, self.relay)
+        return bytes(result)
 
 
 class VersionMessageTest(TestCase):
@@ -212,6 +324,28 @@ class VerAckMessage:
     def serialize(self):
         return b""
 
+    @classmethod
+    def pre_serialized_envelope(cls, network="mainnet"):
+        """Returns the whole serialized envelope, which never changes"""
+        return STATIC_ENVELOPES[cls][network]
+
+
+# messages without a payload always serialize to the same envelope
+STATIC_ENVELOPES = {
+    VerAckMessage: {
+        network: NetworkEnvelope(VerAckMessage.command, b"", network).serialize()
+        for network in MAGIC
+    },
+}
+
+
+class VerAckMessageTest(TestCase):
+    def test_pre_serialized_envelope(self):
+        want = "f9beb4d976657261636b000000000000000000005df6e0e2"
+        self.assertEqual(VerAckMessage.pre_serialized_envelope().hex(), want)
+        want = "0b11090776657261636b000000000000000000005df6e0e2"
+        self.assertEqual(VerAckMessage.pre_serialized_envelope("testnet").hex(), want)
+
 
 class PingMessage:
     command = b"ping"
@@ -259,17 +393,34 @@ class GetHeadersMessage:
         else:
             self.end_block = end_block
 
+    @property
+    def start_block(self):
+        return self.start_block_le[::-1]
+
+    @start_block.setter
+    def start_block(self, start_block):
+        # block hashes are also kept in little endian, ready to serialize
+        self.start_block_le = start_block[::-1]
+
+    @property
+    def end_block(self):
+        return self.end_block_le[::-1]
+
+    @end_block.setter
+    def end_block(self, end_block):
+        self.end_block_le = end_block[::-1]
+
     def serialize(self):
         """Serialize this message to send over the network"""
         # protocol version is 4 bytes little-endian
-        result = int_to_little_endian(self.version, 4)
+        result = bytearray(struct.pack("<I", self.version))
         # number of hashes is a varint
         result += encode_varint(self.num_hashes)
         # start block is in little-endian
-        result += self.start_block[::-1]
+        result += self.start_block_le
         # end block is also in little-endian
-        result += self.end_block[::-1]
-        return result
+        result += self.end_block_le
+        return bytes(result)
 
 
 class GetHeadersMessageTest(TestCase):
@@ -280,14 +431,66 @@ class GetHeadersMessageTest(TestCase):
             gh.serialize().hex(),
             "7f11010001a35bd0ca2f4a88c4eda6d213e2378a5758dfcd6af437120000000000000000000000000000000000000000000000000000000000000000000000000000000000",
         )
+        self.assertEqual(gh.start_block.hex(), block_hex)
+        self.assertEqual(gh.end_block, b"\x00" * 32)
+
+
+class HeadersBatch:
+    """Headers stored column by column instead of as Block objects, so a
+    whole batch can be checked by comparing lists"""
+
+    def __init__(self, raw_headers, prev_blocks, bits, fields):
+        # 80 byte serialization of each header
+        self.raw_headers = raw_headers
+        # previous block of each header, in little endian like on the wire
+        self.prev_blocks = prev_blocks
+        self.bits = bits
+        # fields of the Block objects the batch was made from
+        self.fields = fields
+        self._hashes = None
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        return cls(
+            [b.serialize() for b in blocks],
+            [b.prev_block[::-1] for b in blocks],
+            [b.bits for b in blocks],
+            [cls.header_fields(b) for b in blocks],
+        )
+
+    @staticmethod
+    def header_fields(block):
+        return (
+            block.version,
+            block.prev_block,
+            block.merkle_root,
+            block.timestamp,
+            block.bits,
+            block.nonce,
+        )
+
+    def matches(self, blocks):
+        """Returns whether the batch still describes these blocks, in order"""
+        return list(map(self.header_fields, blocks)) == self.fields
+
+    def hashes(self):
+        """Returns the hash256 of each header in little endian, which is
+        computed only once"""
+        if self._hashes is None:
+            self._hashes = [hash256(raw) for raw in self.raw_headers]
+        return self._hashes
 
 
 class HeadersMessage:
     command = b"headers"
     define_network = False
+    # payload and checksum of the last envelope this message was sent in
+    envelope_cache = None
 
     def __init__(self, headers):
         self.headers = headers
+        # columnar copy of the headers, only used while it matches them
+        self._batch = None
 
     def __iter__(self):
         for header in self.headers:
@@ -297,30 +500,82 @@ class HeadersMessage:
     def parse(cls, s):
         # number of headers is in a varint
         num_headers = read_varint(s)
+        # read all the headers at once and unpack them from the one buffer
+        raw = s.read(num_headers * HEADER_RECORD.size)
+        if len(raw) != num_headers * HEADER_RECORD.size:
+            raise RuntimeError("headers are truncated")
         # initialize the headers array
         headers = []
-        # loop through number of headers times
-        for _ in range(num_headers):
-            # parse a header using Block.parse(s)
-            header = Block.parse(s)
+        # and the columns of the batch
+        raw_headers = []
+        prev_blocks = []
+        all_bits = []
+        all_fields = []
+        for i, (
+            version,
+            prev_block,
+            merkle_root,
+            timestamp,
+            bits,
+            nonce,
+            num_txs,
+        ) in enumerate(HEADER_RECORD.iter_unpack(raw)):
+            # check that the number of txs is 0 or raise a RuntimeError
+            if num_txs != 0:
+                raise RuntimeError("number of txs not 0")
+            # prev_block and merkle_root are little endian in the message
+            header = Block(
+                version,
+                prev_block[::-1],
+                merkle_root[::-1],
+                timestamp,
+                bits,
+                nonce,
+                tx_hashes=[],
+            )
+            # a headers message has no txs, same as Block.parse with 0 txs
+            header.txs = []
+            header.tx_lookup = {}
             # add the header to the headers array
             headers.append(header)
-            # check that the length of header.tx_hashes to be 0 or raise a RuntimeError
-            if len(header.tx_hashes) != 0:
-                raise RuntimeError("number of txs not 0")
-        # return a class instance
-        return cls(headers)
+            # and its fields to the batch, the header is 80 of the 81 bytes
+            start = i * HEADER_RECORD.size
+            raw_headers.append(raw[start : start + 80])
+            prev_blocks.append(prev_block)
+            all_bits.append(bits)
+            all_fields.append(HeadersBatch.header_fields(header))
+        # return a class instance with the batch already filled in
+        message = cls(headers)
+        message._batch = HeadersBatch(raw_headers, prev_blocks, all_bits, all_fields)
+        return message
+
+    def serialize(self):
+        """Serialize this message to send over the network"""
+        result = BytesIO()
+        # number of headers is a varint
+        result.write(encode_varint(len(self.headers)))
+        for header in self.headers:
+            # each header is followed by a tx count of 0
+            result.write(header.serialize())
+            result.write(b"\x00")
+        return result.getvalue()
 
     def is_valid(self):
         """Return whether the headers satisfy proof-of-work and are sequential and have the correct bits"""
-        last_block = None
-        for h in self.headers:
-            if not h.check_pow():
-                return False
-            if last_block and h.prev_block != last_block:
-                return False
-            last_block = h.hash()
-        return True
+        # the headers can be changed after parsing, remake the batch if so
+        if self._batch is None or not self._batch.matches(self.headers):
+            self._batch = HeadersBatch.from_blocks(self.headers)
+        batch = self._batch
+        # each header is hashed once, for both checks
+        hashes = batch.hashes()
+        # every header after the first has to point to the one before it
+        linked = hashes[:-1] == batch.prev_blocks[1:]
+        # bits rarely change within a batch, so work out each target once
+        targets = {bits: bits_to_target(bits) for bits in set(batch.bits)}
+        # every proof, the hash as a little endian number, is below its target
+        proofs = map(little_endian_to_int, hashes)
+        pow_ok = all(map(lt, proofs, map(targets.__getitem__, batch.bits)))
+        return linked & pow_ok
 
 
 class HeadersMessageTest(TestCase):
@@ -331,29 +586,73 @@ class HeadersMessageTest(TestCase):
         self.assertEqual(len(headers.headers), 2)
         for b in headers.headers:
             self.assertEqual(b.__class__, Block)
+            self.assertEqual(b.txs, [])
+            self.assertEqual(b.tx_lookup, {})
+            self.assertEqual(list(b.get_tx_out_scripts()), [])
+
+    def test_serialize(self):
+        hex_msg = "0200000020df3b053dc46f162a9b00c7f0d5124e2676d47bbe7c5d0793a500000000000000ef445fef2ed495c275892206ca533e7411907971013ab83e3b47bd0d692d14d4dc7c835b67d8001ac157e670000000002030eb2540c41025690160a1014c577061596e32e426b712c7ca00000000000000768b89f07044e6130ead292a3f51951adbd2202df447d98789339937fd006bd44880835b67d8001ade09204600"
+        stream = BytesIO(bytes.fromhex(hex_msg))
+        headers = HeadersMessage.parse(stream)
+        self.assertEqual(headers.serialize().hex(), hex_msg)
+
+    def test_is_valid(self):
+        hex_msg = "0200000020df3b053dc46f162a9b00c7f0d5124e2676d47bbe7c5d0793a500000000000000ef445fef2ed495c275892206ca533e7411907971013ab83e3b47bd0d692d14d4dc7c835b67d8001ac157e670000000002030eb2540c41025690160a1014c577061596e32e426b712c7ca00000000000000768b89f07044e6130ead292a3f51951adbd2202df447d98789339937fd006bd44880835b67d8001ade09204600"
+        stream = BytesIO(bytes.fromhex(hex_msg))
+        headers = HeadersMessage.parse(stream)
+        self.assertTrue(headers.is_valid())
+        self.assertTrue(HeadersMessage(headers.headers).is_valid())
+        self.assertFalse(HeadersMessage(headers.headers[::-1]).is_valid())
+        first, second = headers.headers
+        second.nonce = b"\x00" * 4
+        self.assertFalse(HeadersMessage([first, second]).is_valid())
+
+    def test_is_valid_after_change(self):
+        hex_msg = "0200000020df3b053dc46f162a9b00c7f0d5124e2676d47bbe7c5d0793a500000000000000ef445fef2ed495c275892206ca533e7411907971013ab83e3b47bd0d692d14d4dc7c835b67d8001ac157e670000000002030eb2540c41025690160a1014c577061596e32e426b712c7ca00000000000000768b89f07044e6130ead292a3f51951adbd2202df447d98789339937fd006bd44880835b67d8001ade09204600"
+        headers = HeadersMessage.parse(BytesIO(bytes.fromhex(hex_msg)))
+        self.assertTrue(headers.is_valid())
+        headers.headers.reverse()
+        self.assertFalse(headers.is_valid())
+        headers.headers.reverse()
+        self.assertTrue(headers.is_valid())
+        headers.headers[1].nonce = b"\x00" * 4
+        self.assertFalse(headers.is_valid())
 
 
 class GetDataMessage:
     command = b"getdata"
     define_network = False
+    # payload and checksum of the last envelope this message was sent in
+    envelope_cache = None
 
     def __init__(self):
         self.data = []
+        # each identifier in self.data and its little endian form, so
+        # serializing doesn't have to reverse it again
+        self.identifiers_le = []
 
     def add_data(self, data_type, identifier):
+        identifier = bytes(identifier)
         self.data.append((data_type, identifier))
+        self.identifiers_le.append((identifier, identifier[::-1]))
 
     def serialize(self):
+        result = BytesIO()
         # start with the number of items as a varint
-        result = encode_varint(len(self.data))
+        result.write(encode_varint(len(self.data)))
+        known = self.identifiers_le
         # loop through self.data which is a list of data_type and identifier
-        for data_type, identifier in self.data:
+        for i, (data_type, identifier) in enumerate(self.data):
             # data type is 4 bytes little endian
-            result += int_to_little_endian(data_type, 4)
-            # identifier needs to be in little endian
-            result += identifier[::-1]
+            # identifier needs to be in little endian, usually already known
+            # unless self.data was changed directly
+            if i < len(known) and known[i][0] is identifier:
+                identifier_le = known[i][1]
+            else:
+                identifier_le = identifier[::-1]
+            result.write(INVENTORY_ITEM.pack(data_type, identifier_le))
         # return the whole thing
-        return result
+        return result.getvalue()
 
 
 class GetDataMessageTest(TestCase):
@@ -369,6 +668,21 @@ class GetDataMessageTest(TestCase):
         )
         get_data.add_data(FILTERED_BLOCK_DATA_TYPE, block2)
         self.assertEqual(get_data.serialize().hex(), hex_msg)
+        # data keeps the identifiers as they were given
+        self.assertEqual(get_data.data[0], (FILTERED_BLOCK_DATA_TYPE, block1))
+        # entries changed directly are still serialized correctly
+        get_data.data[1] = (FILTERED_BLOCK_DATA_TYPE, block1)
+        self.assertEqual(get_data.serialize()[-32:], block1[::-1])
+        del get_data.data[0]
+        self.assertEqual(get_data.serialize()[1:], bytes.fromhex(hex_msg)[1:37])
+
+    def test_serialize_bytearray(self):
+        block = bytearray(32)
+        block[0] = 1
+        get_data = GetDataMessage()
+        get_data.add_data(BLOCK_DATA_TYPE, block)
+        self.assertEqual(get_data.data, [(BLOCK_DATA_TYPE, bytes(block))])
+        self.assertEqual(get_data.serialize()[5:], bytes(block[::-1]))
 
 
 class GenericMessage:
@@ -382,17 +696,33 @@ class GenericMessage:
         return self.payload
 
 
+@lru_cache(maxsize=32)
+def _command_to_class(message_classes):
+    """Returns a dict of command to message class, built once per tuple of
+    message classes"""
+    return {m.command: m for m in message_classes}
+
+
 class SimpleNode:
-    def __init__(self, host, port=None, network="mainnet", logging=False):
+    def __init__(
+        self, host, port=None, network="mainnet", logging=False, trust_peer=False
+    ):
         if port is None:
             port = PORT[network]
         self.network = network
+        # look the magic up once instead of for every message
+        self._magic = MAGIC[network]
         self.logging = logging
+        # checksums from a trusted peer aren't worth hashing the payload for
+        self.verify_checksum = not trust_peer
         # connect to socket
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect((host, port))
-        # create a stream that we can use with the rest of the library
-        self.stream = self.socket.makefile("rb", None)
+        # receive buffer, unread data is between self._head and self._tail
+        self._buf = bytearray(RECV_BUFFER_SIZE)
+        self._view = memoryview(self._buf)
+        self._head = 0
+        self._tail = 0
 
     def handshake(self):
         """Do a handshake with the other node. Handshake is sending a version message and getting a verack back."""
@@ -403,35 +733,192 @@ class SimpleNode:
         # wait for a verack message
         self.wait_for(VerAckMessage)
 
-    def send(self, message):
-        """Send a message to the connected node"""
+    def _buffers(self, message):
+        """Returns the envelope header and payload to send for a message"""
+        static = STATIC_ENVELOPES.get(message.__class__)
+        if static is not None:
+            # the whole envelope is known already
+            if self.logging:
+                print(f"sending: {NetworkEnvelope(message.command, b'')}")
+            return [static[self.network]]
+        payload = message.serialize()
+        # reuse the checksum from a previous send if the payload is unchanged,
+        # comparing bytes is much cheaper than hashing them
+        checksum = None
+        cache = getattr(message, "envelope_cache", None)
+        if cache is not None and cache[0] == payload:
+            checksum = cache[1]
         # create a network envelope
         envelope = NetworkEnvelope(
-            message.command, message.serialize(), network=self.network
+            message.command,
+            payload,
+            checksum=checksum,
+            magic=self._magic,
         )
         if self.logging:
             print(f"sending: {envelope}")
-        # send the serialized envelope over the socket using sendall
-        self.socket.sendall(envelope.serialize())
+        header = envelope.serialize_header()
+        # remember the checksum so that resending this message skips the hash
+        if hasattr(message, "envelope_cache"):
+            message.envelope_cache = (payload, envelope.checksum)
+        return [header, envelope.payload]
+
+    def _sendall(self, buffers):
+        """Send all the buffers in order without concatenating them"""
+        if not hasattr(self.socket, "sendmsg"):
+            # no sendmsg (Windows), so fall back to one concatenated sendall
+            self.socket.sendall(b"".join(buffers))
+            return
+        buffers = [memoryview(b) for b in buffers if b]
+        i = 0
+        while i < len(buffers):
+            # the kernel gathers the buffers itself, but may send only part
+            sent = self.socket.sendmsg(buffers[i : i + IOV_MAX])
+            # skip past the buffers that went out completely
+            while i < len(buffers) and sent >= len(buffers[i]):
+                sent -= len(buffers[i])
+                i += 1
+            # keep the rest of a buffer that only went out partially
+            if sent:
+                buffers[i] = buffers[i][sent:]
 
-    def read(self):
-        """Read a message from the socket"""
-        envelope = NetworkEnvelope.parse(self.stream, network=self.network)
+    def send(self, message):
+        """Send a message to the connected node"""
+        # send the envelope header and the payload over the socket
+        self._sendall(self._buffers(message))
+
+    def send_many(self, messages):
+        """Send several messages to the connected node in a single write"""
+        buffers = []
+        for message in messages:
+            buffers.extend(self._buffers(message))
+        # all the envelopes go out together
+        self._sendall(buffers)
+
+    def _make_room(self, n):
+        """Make sure the buffer can hold n unread bytes from self._head on"""
+        if self._head + n > len(self._buf):
+            # not enough room left, so move the unread bytes to the front,
+            # in a bigger buffer if the message doesn't fit at all
+            unread = bytes(self._view[self._head : self._tail])
+            if n > len(self._buf):
+                self._buf = bytearray(n)
+                self._view = memoryview(self._buf)
+            self._view[: len(unread)] = unread
+            self._head = 0
+            self._tail = len(unread)
+
+    def _recv(self):
+        """Receive once from the socket into the free end of the buffer"""
+        received = self.socket.recv_into(self._view[self._tail :])
+        if received == 0:
+            raise RuntimeError("Connection reset!")
+        self._tail += received
+        return received
+
+    def _fill(self, n):
+        """Receive from the socket until at least n unread bytes are buffered"""
+        if self._tail - self._head >= n:
+            return
+        self._make_room(n)
+        while self._tail - self._head < n:
+            self._recv()
+
+    def _next_message_length(self):
+        """Returns the length of the next whole message in the buffer, or
+        the length of its header if that hasn't all arrived yet"""
+        if self._tail - self._head < 24:
+            return 24
+        header = self._view[self._head : self._head + 24]
+        _, payload_length, _ = NetworkEnvelope.parse_header(header, self._magic)
+        return 24 + payload_length
+
+    def _take(self, n):
+        """Returns a view of the next n buffered bytes and consumes them"""
+        view = self._view[self._head : self._head + n]
+        self._head += n
+        if self._head == self._tail:
+            # everything has been read, so start over at the front
+            self._head = self._tail = 0
+            if len(self._buf) > RECV_BUFFER_SIZE:
+                # don't hang on to the memory of one big message, the view
+                # returned keeps the old buffer alive for as long as needed
+                self._buf = bytearray(RECV_BUFFER_SIZE)
+                self._view = memoryview(self._buf)
+        return view
+
+    def fileno(self):
+        """Returns the socket's file descriptor, so that many nodes can be
+        watched at once with the selectors module (epoll on Linux)"""
+        return self.socket.fileno()
+
+    def has_message(self):
+        """Returns whether a whole message is already in the receive buffer,
+        in which case read() doesn't need the socket"""
+        return self._tail - self._head >= self._next_message_length()
+
+    def receive(self):
+        """Receive once from the socket and return the number of bytes.
+        Call this when a selector says the socket is readable, then read()
+        while has_message(): a peer that has only sent part of a message
+        never blocks the others"""
+        # room for the rest of the current message and at least one byte
+        unread = self._tail - self._head
+        self._make_room(max(self._next_message_length(), unread + 1))
+        return self._recv()
+
+    def _skip(self, n):
+        """Discard the next n bytes without keeping more than a buffer's worth"""
+        while n > 0:
+            self._fill(1)
+            chunk = min(n, self._tail - self._head)
+            self._take(chunk)
+            n -= chunk
+
+    def read_header(self):
+        """Read the next envelope header from the socket and return the
+        command, payload length and checksum"""
+        self._fill(24)
+        return NetworkEnvelope.parse_header(self._take(24), self._magic)
+
+    def read_payload(self, command, payload_length, checksum):
+        """Read the payload that goes with a header from read_header and
+        return the whole envelope"""
+        self._fill(payload_length)
+        envelope = NetworkEnvelope.from_payload(
+            command,
+            self._take(payload_length),
+            checksum,
+            self._magic,
+            verify_checksum=self.verify_checksum,
+        )
         if self.logging:
             print(f"receiving: {envelope}")
         return envelope
 
+    def read(self):
+        """Read a message from the socket"""
+        return self.read_payload(*self.read_header())
+
     def wait_for(self, *message_classes):
         """Wait for one of the messages in the list"""
         # initialize the command we have, which should be None
         command = None
-        command_to_class = {m.command: m for m in message_classes}
+        command_to_class = _command_to_class(message_classes)
         # loop until the command is in the commands we want
-        while command not in command_to_class.keys():
-            # get the next network message
-            envelope = self.read()
-            # set the command to be evaluated
-            command = envelope.command
+        while command not in command_to_class:
+            # get the next network message header
+            command, payload_length, checksum = self.read_header()
+            if command not in command_to_class and command not in (
+                VersionMessage.command,
+                PingMessage.command,
+            ):
+                # nothing to do with this one, so skip it without hashing
+                if self.logging:
+                    print(f"skipping: {command.decode('ascii')}")
+                self._skip(payload_length)
+                continue
+            envelope = self.read_payload(command, payload_length, checksum)
             # we know how to respond to version and ping, handle that here
             if command == VersionMessage.command:
                 # send verack
@@ -486,3 +973,193 @@ class SimpleNodeTest(TestCase):
         want = "00000000b4a283fd078500ef347c1646985261f925a4d4b67c143cc1ba2a3b57"
         b = node.get_block(bytes.fromhex(want))
         self.assertEqual(b.hash().hex(), want)
+
+
+class SimpleNodeLocalTest(TestCase):
+    def local_node(self, **kwargs):
+        """Returns a SimpleNode connected to a local socket and that socket"""
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        node = SimpleNode("127.0.0.1", port=server.getsockname()[1], **kwargs)
+        peer, _ = server.accept()
+        server.close()
+        self.addCleanup(node.socket.close)
+        self.addCleanup(peer.close)
+        return node, peer
+
+    def test_checksum_cache(self):
+        node, peer = self.local_node()
+        stream = peer.makefile("rb", None)
+        get_data = GetDataMessage()
+        get_data.add_data(BLOCK_DATA_TYPE, b"\x11" * 32)
+        node.send(get_data)
+        payload, checksum = get_data.envelope_cache
+        self.assertEqual(checksum, hash256(payload)[:4])
+        # an unchanged payload reuses the cached checksum without hashing
+        get_data.envelope_cache = (payload, b"\xff" * 4)
+        header, _ = node._buffers(get_data)
+        self.assertEqual(header[20:24], b"\xff" * 4)
+        get_data.envelope_cache = (payload, checksum)
+        # changing the data directly still sends a valid checksum
+        get_data.data[0] = (TX_DATA_TYPE, b"\x22" * 32)
+        node.send(get_data)
+        self.assertEqual(NetworkEnvelope.parse(stream).payload, payload)
+        envelope = NetworkEnvelope.parse(stream)
+        self.assertEqual(envelope.payload, get_data.serialize())
+        self.assertNotEqual(get_data.envelope_cache[1], checksum)
+
+    def test_send_many(self):
+        node, peer = self.local_node()
+        stream = peer.makefile("rb", None)
+        get_data = GetDataMessage()
+        get_data.add_data(BLOCK_DATA_TYPE, b"\x33" * 32)
+        messages = [get_data, VerAckMessage(), PingMessage(b"\x04" * 8)]
+        for _ in range(2):
+            # the second time the getdata checksum comes from the cache
+            node.send_many(messages)
+            envelope = NetworkEnvelope.parse(stream)
+            self.assertEqual(envelope.command, b"getdata")
+            self.assertEqual(envelope.payload, get_data.serialize())
+            self.assertEqual(envelope.checksum, get_data.envelope_cache[1])
+            self.assertEqual(stream.read(24), VerAckMessage.pre_serialized_envelope())
+            envelope = NetworkEnvelope.parse(stream)
+            self.assertEqual(envelope.command, b"ping")
+            self.assertEqual(envelope.payload, b"\x04" * 8)
+
+    def test_sendall_partial(self):
+        class ShortWriteSocket:
+            """Accepts fewer bytes than it is given, like a full kernel buffer"""
+
+            def __init__(self, limits):
+                self.limits = limits
+                self.calls = []
+                self.sent = bytearray()
+
+            def sendmsg(self, buffers):
+                self.calls.append(len(buffers))
+                data = b"".join(buffers)
+                if self.limits:
+                    data = data[: self.limits.pop(0)]
+                self.sent += data
+                return len(data)
+
+        node, _ = self.local_node()
+        node.socket = ShortWriteSocket([7, 24, 1000])
+        buffers = [bytes([i % 256]) * 3 for i in range(1500)]
+        # empty buffers are never handed to sendmsg
+        node._sendall(buffers + [b""])
+        self.assertEqual(node.socket.sent, b"".join(buffers))
+        # the first write is cut at IOV_MAX buffers, then short writes resume
+        # part way through a buffer
+        self.assertEqual(node.socket.calls[0], IOV_MAX)
+        self.assertTrue(max(node.socket.calls) <= IOV_MAX)
+        self.assertEqual(node.socket.calls[1:4], [IOV_MAX, IOV_MAX, IOV_MAX])
+        self.assertEqual(len(node.socket.calls), 5)
+
+    def test_sendall_without_sendmsg(self):
+        class StreamSocket:
+            def __init__(self):
+                self.calls = []
+
+            def sendall(self, data):
+                self.calls.append(data)
+
+        node, _ = self.local_node()
+        node.socket = StreamSocket()
+        node._sendall([b"\x01" * 24, b"", b"\x02" * 8])
+        self.assertEqual(node.socket.calls, [b"\x01" * 24 + b"\x02" * 8])
+
+    def test_trust_peer(self):
+        ping = NetworkEnvelope(b"ping", b"\x05" * 8).serialize()
+        bad_ping = ping[:20] + b"\x00" * 4 + ping[24:]
+        node, peer = self.local_node()
+        peer.sendall(bad_ping)
+        with self.assertRaises(RuntimeError):
+            node.read()
+        trusting_node, trusted_peer = self.local_node(trust_peer=True)
+        trusted_peer.sendall(bad_ping)
+        envelope = trusting_node.read()
+        self.assertEqual(envelope.payload, b"\x05" * 8)
+        # the unchecked checksum isn't kept, so serializing computes it again
+        self.assertEqual(envelope.serialize(), ping)
+
+    def test_read(self):
+        node, peer = self.local_node()
+        ping = NetworkEnvelope(b"ping", b"\x01" * 8).serialize()
+        verack = VerAckMessage.pre_serialized_envelope()
+        # several messages arriving together
+        peer.sendall(ping + verack + ping)
+        self.assertEqual(node.read().payload, b"\x01" * 8)
+        self.assertEqual(node.read().command, b"verack")
+        self.assertEqual(node.read().command, b"ping")
+        # a header split across two receives
+        peer.sendall(ping[:10])
+        threading.Timer(0.1, peer.sendall, [ping[10:]]).start()
+        self.assertEqual(node.read().payload, b"\x01" * 8)
+
+    def test_read_large(self):
+        node, peer = self.local_node()
+        payload = bytes(range(256)) * (3 * 1024 * 4)
+        self.assertTrue(len(payload) > RECV_BUFFER_SIZE)
+        block = NetworkEnvelope(b"block", payload).serialize()
+        verack = VerAckMessage.pre_serialized_envelope()
+        sender = threading.Thread(target=peer.sendall, args=(block + verack,))
+        sender.start()
+        self.assertEqual(node.read().payload, payload)
+        self.assertEqual(node.read().command, b"verack")
+        sender.join()
+        # the buffer goes back to its normal size afterwards
+        self.assertEqual(len(node._buf), RECV_BUFFER_SIZE)
+
+    def test_read_too_long(self):
+        node, peer = self.local_node()
+        header = NetworkEnvelope(b"block", b"").serialize_header()
+        too_long = int_to_little_endian(MAX_PAYLOAD_LENGTH + 1, 4)
+        peer.sendall(header[:16] + too_long + header[20:])
+        with self.assertRaises(RuntimeError):
+            node.read()
+
+    def test_receive(self):
+        node_1, peer_1 = self.local_node()
+        node_2, peer_2 = self.local_node()
+        ping = NetworkEnvelope(b"ping", b"\x03" * 8).serialize()
+        verack = VerAckMessage.pre_serialized_envelope()
+        # the first peer only sends part of a message
+        peer_1.sendall(ping[:30])
+        peer_2.sendall(ping + verack)
+        selector = selectors.DefaultSelector()
+        self.addCleanup(selector.close)
+        selector.register(node_1, selectors.EVENT_READ)
+        selector.register(node_2, selectors.EVENT_READ)
+        commands = {node_1: [], node_2: []}
+        ready = {node_1, node_2}
+        while ready:
+            events = selector.select(timeout=1)
+            # a node that never becomes readable fails instead of hanging
+            self.assertTrue(events)
+            for key, _ in events:
+                node = key.fileobj
+                node.receive()
+                ready.discard(node)
+                while node.has_message():
+                    commands[node].append(node.read().command)
+        self.assertEqual(commands, {node_1: [], node_2: [b"ping", b"verack"]})
+        peer_1.sendall(ping[30:])
+        node_1.receive()
+        self.assertTrue(node_1.has_message())
+        self.assertEqual(node_1.read().payload, b"\x03" * 8)
+
+    def test_wait_for(self):
+        node, peer = self.local_node()
+        inv = NetworkEnvelope(b"inv", b"\x00" * 37).serialize()
+        # a bad checksum shows the skipped payload is never hashed
+        inv = inv[:20] + b"\x00" * 4 + inv[24:]
+        ping = NetworkEnvelope(b"ping", b"\x02" * 8).serialize()
+        verack = VerAckMessage.pre_serialized_envelope()
+        peer.sendall(inv + ping + verack)
+        self.assertEqual(node.wait_for(VerAckMessage).__class__, VerAckMessage)
+        # the ping got answered with a pong
+        pong = NetworkEnvelope.parse(peer.makefile("rb", None))
+        self.assertEqual(pong.command, b"pong")
+        self.assertEqual(pong.payload, b"\x02" * 8)
@@ -70,6 +70,8 @@ class TxFetcher:
 class Tx:
     command = b"tx"
     define_network = True
+    # payload and checksum of the last envelope this tx was sent in
+    envelope_cache = None
 
     def __init__(
         self, version, tx_ins, tx_outs, locktime, network="mainnet", segwit=False